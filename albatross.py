@@ -6,19 +6,62 @@ Albatross - A tool for migrating a GitLab.com group/project to a self-hosted ins
 Copyright (c) 2022 THETC The Techno Creatives AB
 """
 
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from git import Repo
+from functools import partial, wraps
+from gitlab.v4.objects import Project
+from operator import attrgetter
 from pprint import pprint as pp
-from time import sleep
-from typing import Any, Callable, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from time import monotonic, sleep
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+from urllib3.util.retry import Retry
 import click
 import gitlab
+import hashlib
 import json
 import logging
-import math
 import os
+import queue
 import requests
+import subprocess
 import tempfile
+import threading
+
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s   %(message)s"
+_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+_PER_PAGE = 100
+# Seconds to wait on a stalled API connection before giving up
+_API_TIMEOUT = 30
+_PAGE_WORKERS = 8
+_API_WORKERS = 10
+# Sibling subgroups walked at once, per level; they mostly wait on project_pool
+_GROUP_WORKERS = 4
+# Seconds a server-side import may stay scheduled or started before the project fails
+_SERVER_IMPORT_TIMEOUT = 3600
+# Set by _prepare_logger; checked by _call_logger on every call, so keep it cheap
+_trace_calls = False
+# GitLab itself refuses avatars above 200 KiB, so anything this big is not an image
+_MAX_AVATAR_SIZE = 2 * 1024 * 1024
+_AVATAR_CHUNK_SIZE = 64 * 1024
+# Attributes copied verbatim into create payloads; the optional ones only when set
+_VARIABLE_FIELDS = (
+    "key",
+    "value",
+    "environment_scope",
+    "masked",
+    "protected",
+    "variable_type",
+)
+_LABEL_FIELDS = ("name", "color")
+_LABEL_OPTIONAL_FIELDS = ("description", "priority")
+_MILESTONE_FIELDS = ("title", "description")
+_MILESTONE_OPTIONAL_FIELDS = ("due_date", "start_date")
+# A mirror clone is bare, so there is no checkout to smudge; skipping the LFS filter
+# outright keeps it that way regardless of local git-lfs config
+_GIT_ENV = {**os.environ, "GIT_LFS_SKIP_SMUDGE": "1", "GIT_TERMINAL_PROMPT": "0"}
 
 
 @dataclass
@@ -33,26 +76,40 @@ class AlbatrossData:
     state_map: dict
     state_file: Any
     sleep_time: int
+    project_pool: ThreadPoolExecutor
+    state_lock: threading.Lock
+    pool: ThreadPoolExecutor
+    source_git_env: dict
+    dest_git_env: dict
+    server_import: bool
+    reference_cache: Optional[str]
+    reference_lock: threading.Lock
+    staging_slots: threading.BoundedSemaphore
+    dest_groups: dict
+    projects_in_flight: set
+    aborting: threading.Event
 
 
 def _prepare_logger(func: Callable) -> Callable:
     """Janky wrapper to prepare the logger before we start invoking it"""
 
+    @wraps(func)
     def inner(*args: tuple, **kwargs: dict) -> Any:
-        log_format = "%(asctime)s %(levelname)s   %(message)s"
-        date_format = "%Y-%m-%d %H:%M:%S"
+        global _trace_calls
+        _trace_calls = kwargs["debug"]
         if kwargs["debug"]:
-            logging.basicConfig(
-                level=logging.DEBUG, format=log_format, datefmt=date_format
-            )
+            level = logging.DEBUG
         elif kwargs["verbose"]:
-            logging.basicConfig(
-                level=logging.INFO, format=log_format, datefmt=date_format
-            )
+            level = logging.INFO
         else:
-            logging.basicConfig(
-                level=logging.WARNING, format=log_format, datefmt=date_format
-            )
+            level = logging.WARNING
+        root = logging.getLogger()
+        # basicConfig would silently keep the old level on a second run in-process
+        if not root.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(_LOG_FORMAT, _DATE_FORMAT))
+            root.addHandler(handler)
+        root.setLevel(level)
         logging.debug("Logging started")
 
         return func(*args, **kwargs)
@@ -60,23 +117,202 @@ def _prepare_logger(func: Callable) -> Callable:
     return inner
 
 
-def _json_dump_helper(data: dict, fd: Any) -> None:
-    fd.truncate(0)
-    fd.seek(0)
-    json.dump(data, fd, separators=(",", ":"))
-    logging.debug("Flushing and syncing statefile content")
+def _journal(event: dict, fd: Any, sync: bool = True) -> None:
+    """Appends one state change to the statefile"""
+    fd.write(json.dumps(event, separators=(",", ":")) + "\n")
+    logging.debug("Flushing statefile content")
     fd.flush()
+    if sync:
+        logging.debug("Syncing statefile to disk")
+        os.fsync(fd.fileno())
+
+
+def _replay_journal(fd: Any) -> dict:
+    """Rebuilds the state map from the statefile's events"""
+    state: dict = {"group": {}, "project": {}}
+    lines = [line for line in fd if line.strip()]
+    for number, line in enumerate(lines, start=1):
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            if number < len(lines):
+                raise
+            # A crash mid-append tears at most the last event, which never got synced
+            logging.warning("Ignoring torn last line of the statefile: %r", line)
+            break
+        op = event.get("op")
+        if op is None:
+            # Statefile from before the journal: one snapshot of the whole map, which
+            # JSON forced to string keys
+            state = {
+                kind: {int(src): entry for src, entry in entries.items()}
+                for kind, entries in event.items()
+            }
+        elif op == "group":
+            state["group"][event["src"]] = {"id": event["dst"]}
+        elif op == "project_start":
+            state["project"][event["src"]] = {"id": event["dst"], "done": False}
+        elif op == "project_done":
+            state["project"][event["src"]]["done"] = True
+        elif op == "project_delete":
+            state["project"].pop(event["src"], None)
+    return state
+
+
+def _compact_journal(state: dict, fd: Any) -> None:
+    """Writes just enough events to rebuild state into a fresh statefile"""
+    for src, group in state["group"].items():
+        _journal({"op": "group", "src": src, "dst": group["id"]}, fd, sync=False)
+    for src, project in state["project"].items():
+        event = {"op": "project_start", "src": src, "dst": project["id"]}
+        _journal(event, fd, sync=False)
+        if project["done"]:
+            _journal({"op": "project_done", "src": src}, fd, sync=False)
     os.fsync(fd.fileno())
 
 
-def _pause(data: AlbatrossData) -> None:
-    logging.debug(
-        "Letting the destination breathe for {} seconds".format(data.sleep_time)
+def _prefetch(iterable: Iterable[Any]) -> Iterator[Any]:
+    """Iterates on a background thread, so the consumer never waits on a page fetch"""
+    buffer: queue.SimpleQueue = queue.SimpleQueue()
+    done = object()
+
+    def fill() -> None:
+        try:
+            for item in iterable:
+                buffer.put(item)
+        finally:
+            buffer.put(done)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        filled = executor.submit(fill)
+        yield from iter(buffer.get, done)
+        # Re-raises whatever stopped the iteration early
+        filled.result()
+
+
+def _list_all(manager: Any, **kwargs: Any) -> Iterator[Any]:
+    """Yields every object of a manager, in order, while later pages are still being
+    fetched in the background"""
+    first = manager.list(as_list=False, **kwargs)
+    total_pages = first.total_pages
+    if total_pages is None or first.per_page is None:
+        # GitLab leaves out the totals for very large result sets, so just follow the
+        # next-links one page at a time
+        yield from _prefetch(first)
+        return
+    with ThreadPoolExecutor(max_workers=_PAGE_WORKERS) as executor:
+        pages = executor.map(
+            lambda page: manager.list(page=page, per_page=first.per_page, **kwargs),
+            range(2, total_pages + 1),
+        )
+        # Page 2 onwards is the pool's; python-gitlab has no public way to stop a list
+        # at its page, so keep it from following the next-link into page 2. Not a
+        # count either: GitLab may drop unreadable items (e.g. notes) from a page
+        first._list._get_next = False
+        yield from first
+        for page in pages:
+            yield from page
+
+
+def _authenticated_url(url: str, gl: gitlab.client.Gitlab) -> str:
+    scheme, rest = url.split("://", 1)
+    return "{}://{}:{}@{}".format(scheme, gl.user.username, gl.private_token, rest)
+
+
+def _git_env(gl: gitlab.client.Gitlab) -> dict:
+    """Environment for git commands against gl, passing its credentials as a header"""
+    credentials = "{}:{}".format(gl.user.username, gl.private_token)
+    # Given through the environment so the token never lands in a remote URL or in
+    # the staged repository's config
+    return {
+        **_GIT_ENV,
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": "http.extraHeader",
+        "GIT_CONFIG_VALUE_0": "Authorization: Basic {}".format(
+            b64encode(credentials.encode("utf-8")).decode("ascii")
+        ),
+    }
+
+
+def _git(*args: str, cwd: Optional[str] = None, env: dict = _GIT_ENV) -> None:
+    result = subprocess.run(
+        ["git", *args], cwd=cwd, env=env, capture_output=True, text=True
     )
+    if result.stdout:
+        logging.debug("git %s output: %s", args[0], result.stdout.strip())
+    if result.returncode != 0:
+        logging.error("git %s failed: %s", args[0], result.stderr.strip())
+    elif result.stderr:
+        # git reports progress and most status on stderr, even when it succeeds
+        logging.debug("git %s messages: %s", args[0], result.stderr.strip())
+    result.check_returncode()
+
+
+def _payload(
+    obj: Any, fields: Tuple[str, ...], optional_fields: Tuple[str, ...] = ()
+) -> dict:
+    """Copies fields from obj into a create payload, plus any optional_fields that
+    are set"""
+    values = attrgetter(*fields)(obj)
+    # attrgetter only returns a tuple when asked for more than one attribute
+    payload = dict(zip(fields, values if len(fields) > 1 else (values,)))
+    for field in optional_fields:
+        value = getattr(obj, field)
+        if value is not None:
+            payload[field] = value
+    return payload
+
+
+def _create_all(
+    manager: Any, payloads: list[dict], data: AlbatrossData, backoff: bool = False
+) -> int:
+    """Creates one object per payload, concurrently on the shared API pool. Returns how
+    many were created; with backoff, ones that turn out to exist already don't count"""
+    create = partial(_with_backoff, manager.create) if backoff else manager.create
+    return sum(1 for created in data.pool.map(create, payloads) if created is not None)
+
+
+def _with_backoff(call: Callable, *args: Any, attempts: int = 5) -> Any:
+    """Retries a create call with exponential backoff while GitLab isn't ready for it.
+    Returns None if the object already exists"""
+    for attempt in range(attempts):
+        try:
+            return call(*args)
+        except gitlab.exceptions.GitlabCreateError as e:
+            if e.response_code == 409:
+                # E.g. the destination protected the default branch itself on push
+                logging.debug("Create conflicts with an existing object: %s", e)
+                return None
+            # Other 4xx won't change on a retry; 422 is what a not yet processed push
+            # looks like
+            transient = (
+                e.response_code is None
+                or e.response_code == 422
+                or e.response_code >= 500
+            )
+            if not transient or attempt == attempts - 1:
+                raise
+            delay = min(0.5 * 2**attempt, 8)
+            logging.debug("Create rejected, retrying in %s seconds", delay)
+            sleep(delay)
+
+
+def _get_dest_group(gid: int, data: AlbatrossData) -> Any:
+    """Destination group by ID, fetched once per run"""
+    group = data.dest_groups.get(gid)
+    if group is None:
+        # Concurrent walkers may both fetch a missing group; either copy will do
+        group = data.dest_groups.setdefault(gid, data.dest.groups.get(gid))
+    return group
+
+
+def _pause(data: AlbatrossData) -> None:
+    logging.debug("Letting the destination breathe for %s seconds", data.sleep_time)
     sleep(data.sleep_time)
 
 
 def _wrap_statefile(func: Callable) -> Callable:
+    @wraps(func)
     def inner(*args: tuple, **kwargs: dict) -> Any:
         statefile = ".albatross-state"
         state = {"group": {}, "project": {}}
@@ -85,8 +321,8 @@ def _wrap_statefile(func: Callable) -> Callable:
         if os.path.exists(statefile):
             logging.warning("Statefile found. Did a previous run error out?")
             with open(statefile, "rt", encoding="utf-8") as f:
-                state = json.load(f)
-            logging.debug("Read state {}".format(state))
+                state = _replay_journal(f)
+            logging.debug("Read state %s", state)
 
         data.state_map = state
         mode = "at" if data.dry_run else "wt"
@@ -94,8 +330,22 @@ def _wrap_statefile(func: Callable) -> Callable:
         with open(statefile, mode, encoding="utf-8") as f:
             data.state_file = f
             if not data.dry_run:
-                _json_dump_helper(state, f)
-            return func(*args, **kwargs)
+                _compact_journal(state, f)
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                # E.g. a failed orphan: whatever is still walking stops at its next
+                # group or project
+                data.aborting.set()
+                raise
+            finally:
+                # Projects still in flight journal as they end, so let them finish while
+                # the file is open; on a crash, queued ones are dropped rather than
+                # started. Projects go first, they need the API pool to finish
+                data.project_pool.shutdown(wait=True, cancel_futures=True)
+                data.pool.shutdown(wait=True, cancel_futures=True)
+                # Catches any completions written without a sync, even on a crash
+                os.fsync(f.fileno())
 
     return inner
 
@@ -103,242 +353,334 @@ def _wrap_statefile(func: Callable) -> Callable:
 def _call_logger(func: Callable) -> Callable:
     """Janky wrapping call logger, for debugging reasons"""
 
+    @wraps(func)
     def inner(*args: tuple, **kwargs: dict) -> Any:
+        if not _trace_calls:
+            return func(*args, **kwargs)
         logging.debug(
-            "CALL to {} with args {} and kwargs {}".format(func.__name__, args, kwargs)
+            "CALL to %s with args %r and kwargs %r", func.__name__, args, kwargs
         )
         return_val = func(*args, **kwargs)
-        logging.debug("RETURN from {} with {}".format(func.__name__, return_val))
+        logging.debug("RETURN from %s with %r", func.__name__, return_val)
         return return_val
 
     return inner
 
 
+def _create_session() -> requests.Session:
+    """Pooled session shared by both GitLab clients and the avatar downloads"""
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Only idempotent methods (urllib3's default) are retried; a retried POST
+            # could create things twice
+            respect_retry_after_header=True,
+            # Hand the last response to python-gitlab rather than raising, so its own
+            # error handling still applies
+            raise_on_status=False,
+        ),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _create_session()
+
+
+def get_session() -> requests.Session:
+    """The shared session; use it for any HTTP request so connections get reused"""
+    return _session
+
+
 @_call_logger
 def open_gitlab_connection(url: str, token: Optional[str]) -> gitlab.client.Gitlab:
-    url = (
-        url
-        if url.startswith("http://") or url.startswith("https://")
-        else "https://" + url
+    url = url if url.startswith(("http://", "https://")) else "https://" + url
+    logging.debug("URL: %s", url)
+    # GitLab's default page size is 20; 100 is the maximum it allows
+    gl = gitlab.Gitlab(
+        url=url,
+        private_token=token,
+        session=get_session(),
+        per_page=_PER_PAGE,
+        timeout=_API_TIMEOUT,
     )
-    logging.debug("URL: {}".format(url))
-    gl = gitlab.Gitlab(url=url, private_token=token)
     gl.auth()
     return gl
 
 
 @_call_logger
-def migrate_avatar(url: str, dest: Any, cookie: str) -> None:
-    avatar_req = requests.get(url, cookies={"_gitlab_session": cookie})
-    if avatar_req.status_code != 200:
-        logging.warning("Failed to retrieve avatar from {}".format(url))
-    else:
-        dest.avatar = avatar_req.content
+def fetch_avatar(url: str, cookie: str) -> Optional[bytes]:
+    # Avatars are cosmetic: any failure to download one only costs the avatar
+    try:
+        with get_session().get(
+            url,
+            cookies={"_gitlab_session": cookie},
+            # Images are compressed already; don't pay for a second round of it
+            headers={"Accept-Encoding": "identity"},
+            stream=True,
+            timeout=(5, 30),
+        ) as avatar_req:
+            avatar_req.raise_for_status()
+            avatar = bytearray()
+            # Counted as it arrives, since Content-Length may be missing or wrong
+            for chunk in avatar_req.iter_content(chunk_size=_AVATAR_CHUNK_SIZE):
+                avatar += chunk
+                if len(avatar) > _MAX_AVATAR_SIZE:
+                    logging.warning("Avatar at %s is too large, skipping it", url)
+                    return None
+    except requests.RequestException as e:
+        logging.warning("Failed to retrieve avatar from %s: %s", url, e)
+        return None
+    # Kept as bytes: requests builds the multipart body in memory either way, and
+    # python-gitlab may have to send it more than once when rate limited
+    return bytes(avatar)
+
+
+def _save_avatar(dest: Any, avatar: bytes) -> None:
+    """Uploads an avatar onto a created project or group. Kept out of the create call,
+    whose multipart form can't carry the other, non-string fields"""
+    dest.avatar = avatar
+    try:
+        dest.save()
+    except gitlab.exceptions.GitlabUpdateError as e:
+        logging.warning("Failed to set avatar of %s: %s", dest.name, e.error_message)
 
 
 @_call_logger
-def migrate_variables(source: Any, dest: Any) -> int:
-    counter = 0
-    for var in source.variables.list():
-        logging.debug("Migrating variable {}".format(var.key))
-        dest.variables.create(
-            {
-                "key": var.key,
-                "value": var.value,
-                "environment_scope": var.environment_scope,
-                "masked": var.masked,
-                "protected": var.protected,
-                "variable_type": var.variable_type,
-            }
-        )
-        counter += 1
-    return counter
+def migrate_variables(source: Any, dest: Any, data: AlbatrossData) -> int:
+    payloads = []
+    for var in _list_all(source.variables):
+        logging.debug("Migrating variable %s", var.key)
+        payloads.append(_payload(var, _VARIABLE_FIELDS))
+    return _create_all(manager=dest.variables, payloads=payloads, data=data)
 
 
 @_call_logger
 def migrate_repo(
-    source_url: str, dest_url: str, data: AlbatrossData
+    source_url: str, dest_url: str, with_lfs: bool, data: AlbatrossData
 ) -> Tuple[str, str]:
-    @_call_logger
     def dir_size(path):
         size = 0
-        for root, _, files in os.walk(path):
-            for f in files:
-                fp = os.path.join(root, f)
-                if os.path.isfile(fp):
-                    size += os.stat(fp).st_size
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
         return size
 
-    @_call_logger
     def format_bytes(bts):
         if bts == 0:
             return "0B"
         size_name = ["B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB"]
-        i = int(math.floor(math.log(bts, 1024)))
-        p = math.pow(1024, i)
-        s = round(bts / p, 2)
+        i = min((bts.bit_length() - 1) // 10, len(size_name) - 1)
+        s = round(bts / (1 << (10 * i)), 2)
         return "{}{}".format(s, size_name[i])
 
-    s_url_split = source_url.split("://")
-    source_url = "{}://{}:{}@{}".format(
-        s_url_split[0],
-        data.source.user.username,
-        data.source.private_token,
-        s_url_split[1],
-    )
-    logging.debug("Auth'd source URL: {}".format(source_url))
-
-    d_url_split = dest_url.split("://")
-    dest_url = "{}://{}:{}@{}".format(
-        d_url_split[0],
-        data.dest.user.username,
-        data.dest.private_token,
-        d_url_split[1],
-    )
-    logging.debug("Auth'd dest URL: {}".format(dest_url))
     with tempfile.TemporaryDirectory() as tdir:
-        logging.debug("Cloning from {} into {}".format(source_url, tdir))
-        repo = Repo.clone_from(url=source_url, to_path=tdir, multi_options=["--mirror"])
-        git_data = dir_size(tdir)
-        logging.debug("Pulling LFS history")
-        repo.git.lfs("fetch", "--all")
-        lfs_data = dir_size(tdir)
+        logging.debug("Cloning from %s into %s", source_url, tdir)
+        reference = []
+        if data.reference_cache is not None:
+            # Objects already in the cache aren't downloaded again. Dissociating
+            # copies them into the clone, so later cache updates can't affect it.
+            reference = ["--reference-if-able", data.reference_cache, "--dissociate"]
+        _git("clone", "--mirror", *reference, source_url, tdir, env=data.source_git_env)
+        if data.reference_cache is not None:
+            seed_reference_cache(repo_path=tdir, source_url=source_url, data=data)
+        if with_lfs:
+            # git-lfs only moves 3 objects at a time by default
+            _git("config", "lfs.concurrenttransfers", "16", cwd=tdir)
+            _git("config", "lfs.transfer.maxretries", "5", cwd=tdir)
+            logging.debug("Pulling LFS history")
+            _git("lfs", "fetch", "--all", cwd=tdir, env=data.source_git_env)
+        else:
+            logging.debug("No LFS objects in %s, skipping LFS", source_url)
+        # LFS keeps its objects under lfs/ in a bare repository
+        lfs_dir = os.path.join(tdir, "lfs")
+        lfs_data = dir_size(lfs_dir) if os.path.isdir(lfs_dir) else 0
+        git_data = dir_size(tdir) - lfs_data
         logging.debug("Adding new remote")
-        repo.create_remote(name="final-destination", url=dest_url)
-        logging.debug("Pushing to {}".format(dest_url))
-        repo.git.lfs("push", "--all", "final-destination")
-        repo.git.push(
+        _git("remote", "add", "final-destination", dest_url, cwd=tdir)
+        logging.debug("Pushing to %s", dest_url)
+        if with_lfs:
+            _git(
+                "lfs",
+                "push",
+                "--all",
+                "final-destination",
+                cwd=tdir,
+                env=data.dest_git_env,
+            )
+        # Not --mirror: the source's refs/merge-requests, refs/pipelines etc. are
+        # read-only on GitLab and would be rejected by the destination
+        _git(
+            "push",
+            "--porcelain",
             "final-destination",
-            all=True,
-            porcelain=True,
+            "refs/heads/*:refs/heads/*",
+            "refs/tags/*:refs/tags/*",
+            cwd=tdir,
+            env=data.dest_git_env,
         )
-        repo.git.push(
-            "final-destination",
-            tags=True,
-            porcelain=True,
+    return (format_bytes(git_data), format_bytes(lfs_data))
+
+
+@_call_logger
+def await_server_import(project: Any, data: AlbatrossData) -> bool:
+    """Waits for a server-side repository import to end. Returns true if it succeeded."""
+    deadline = monotonic() + _SERVER_IMPORT_TIMEOUT
+    project_import = project.imports.get()
+    while project_import.import_status in ["scheduled", "started"]:
+        if monotonic() > deadline:
+            # Staging now would push alongside the import; left unfinished instead, so
+            # the next run deletes the project and starts it over
+            raise TimeoutError(
+                "Server-side import of project {} still {} after {} seconds".format(
+                    project.name, project_import.import_status, _SERVER_IMPORT_TIMEOUT
+                )
+            )
+        logging.debug(
+            "Import of project %s is %s", project.name, project_import.import_status
+        )
+        sleep(data.sleep_time)
+        project_import.refresh()
+    if project_import.import_status != "finished":
+        logging.warning(
+            "Server-side import of project %s ended as %s: %s",
+            project.name,
+            project_import.import_status,
+            project_import.import_error,
         )
-    return (format_bytes(git_data), format_bytes(lfs_data - git_data))
+        return False
+    return True
 
 
 @_call_logger
-def halt_ci(project: Any) -> int:
-    counter = 0
-    logging.debug(
-        "Halting and destroying all CI jobs for project {}".format(project.name)
-    )
-    for pipe in project.pipelines.list(as_list=False):
-        if pipe.status not in ["success", "failed", "canceled", "skipped"]:
-            logging.debug("Destroying pipeline {}".format(pipe.id))
-            pipe.delete()
-            counter += 1
-        else:
-            logging.debug("Pipeline {} is not pending; no action taken".format(pipe.id))
+def seed_reference_cache(repo_path: str, source_url: str, data: AlbatrossData) -> None:
+    # Namespaced per source repository so refs from different projects never clash,
+    # and reruns update rather than duplicate them
+    namespace = hashlib.sha1(source_url.encode("utf-8")).hexdigest()
+    with data.reference_lock:
+        _git(
+            "fetch",
+            "--quiet",
+            "--no-tags",
+            repo_path,
+            "+refs/heads/*:refs/albatross/{}/heads/*".format(namespace),
+            "+refs/tags/*:refs/albatross/{}/tags/*".format(namespace),
+            cwd=data.reference_cache,
+        )
 
-    return counter
+
+@_call_logger
+def halt_ci(project: Any, data: AlbatrossData) -> int:
+    logging.debug("Halting and destroying all CI jobs for project %s", project.name)
+    # Only ever run on a freshly created project, whose few pipelines all come from the
+    # push; one listing filtered here beats a request per status
+    pipes = [
+        pipe
+        for pipe in _list_all(project.pipelines)
+        if pipe.status not in ["success", "failed", "canceled", "skipped"]
+    ]
+
+    def destroy(pipe: Any) -> None:
+        logging.debug("Destroying %s pipeline %s", pipe.status, pipe.id)
+        pipe.delete()
+
+    for _ in data.pool.map(destroy, pipes):
+        pass
+    return len(pipes)
 
 
 @_call_logger
-def migrate_labels(source: Any, dest: Any) -> int:
-    counter = 0
-    for label in source.labels.list(as_list=False):
+def migrate_labels(source: Any, dest: Any, data: AlbatrossData) -> int:
+    payloads = []
+    for label in _list_all(source.labels):
         if not label.is_project_label:
-            logging.debug("Ignored non-project label {}".format(label.name))
+            logging.debug("Ignored non-project label %s", label.name)
             continue
-        args = {
-            "name": label.name,
-            "color": label.color,
-        }
-        if label.description is not None:
-            args["description"] = label.description
-        if label.priority is not None:
-            args["priority"] = label.priority
-        dest.labels.create(args)
-        counter += 1
-    return counter
+        payloads.append(_payload(label, _LABEL_FIELDS, _LABEL_OPTIONAL_FIELDS))
+    return _create_all(manager=dest.labels, payloads=payloads, data=data)
+
+
+def _first_access_level(access_levels: list[dict]) -> int:
+    return access_levels[0]["access_level"] if access_levels else 0
 
 
 @_call_logger
-def migrate_protected_branches(source: Any, dest: Any) -> int:
-    counter = 0
-    pre_protected = dest.protectedbranches.list(all=True)
-    for rule in source.protectedbranches.list(as_list=False):
-        if any(map(lambda e: e.name == rule.name, pre_protected)):
+def migrate_protected_branches(source: Any, dest: Any, data: AlbatrossData) -> int:
+    payloads = []
+    pre_protected = {e.name for e in _list_all(dest.protectedbranches)}
+    for rule in _list_all(source.protectedbranches):
+        if rule.name in pre_protected:
             continue
-        dest.protectedbranches.create(
+        payloads.append(
             {
                 "name": rule.name,
-                "push_access_level": rule.push_access_levels[0]["access_level"]
-                if len(rule.push_access_levels) > 0
-                else 0,
-                "merge_access_level": rule.merge_access_levels[0]["access_level"]
-                if len(rule.merge_access_levels) > 0
-                else 0,
-                "unprotect_access_level": rule.unprotect_access_levels[0][
-                    "access_level"
-                ]
-                if len(rule.unprotect_access_levels) > 0
-                else 0,
+                "push_access_level": _first_access_level(rule.push_access_levels),
+                "merge_access_level": _first_access_level(rule.merge_access_levels),
+                "unprotect_access_level": _first_access_level(
+                    rule.unprotect_access_levels
+                ),
                 "allow_force_push": rule.allow_force_push,
             }
         )
-        counter += 1
-    return counter
+    return _create_all(
+        manager=dest.protectedbranches, payloads=payloads, data=data, backoff=True
+    )
 
 
 @_call_logger
-def migrate_protected_tags(source: Any, dest: Any) -> int:
-    counter = 0
-    pre_protected = dest.protectedtags.list(all=True)
-    for tag in source.protectedtags.list(as_list=False):
-        if any(map(lambda e: e.name == tag.name, pre_protected)):
+def migrate_protected_tags(source: Any, dest: Any, data: AlbatrossData) -> int:
+    payloads = []
+    pre_protected = {e.name for e in _list_all(dest.protectedtags)}
+    for tag in _list_all(source.protectedtags):
+        if tag.name in pre_protected:
             continue
-        dest.protectedtags.create(
+        payloads.append(
             {
                 "name": tag.name,
-                "create_access_level": tag.create_access_levels[0]["access_level"]
-                if len(tag.create_access_levels) > 0
-                else 0,
+                "create_access_level": _first_access_level(tag.create_access_levels),
             }
         )
-        counter += 1
-    return counter
+    return _create_all(
+        manager=dest.protectedtags, payloads=payloads, data=data, backoff=True
+    )
 
 
 @_call_logger
 def migrate_milestones(
     source: Any, dest: Any, data: AlbatrossData
 ) -> Tuple[int, AlbatrossData]:
-    counter = 0
-    for stone in source.milestones.list(as_list=False):
-        args = {
-            "title": stone.title,
-            "description": stone.description,
-        }
-        if stone.due_date is not None:
-            args["due_date"] = stone.due_date
-        if stone.start_date is not None:
-            args["start_date"] = stone.start_date
-        dest.milestones.create(args)
-        counter += 1
+    payloads = []
+    for stone in _list_all(source.milestones):
+        payloads.append(_payload(stone, _MILESTONE_FIELDS, _MILESTONE_OPTIONAL_FIELDS))
+    counter = _create_all(manager=dest.milestones, payloads=payloads, data=data)
     return (counter, data)
 
 
-@_call_logger
-def migrate_notes(source: Any, dest: Any) -> int:
-    counter = 0
-    for note in source.notes.list(as_list=False):
+def migrate_notes(source: Any, dest: Any, data: AlbatrossData) -> int:
+    payloads = []
+    for note in _list_all(source.notes):
         body = "{}By {}: {}".format(
             "[SYSTEM NOTE] " if note.system else "", note.author["name"], note.body
         )
-        dest.notes.create(
+        payloads.append(
             {
                 "body": body,
                 "confidential": note.confidential,
                 "created_at": note.created_at,
             }
         )
-        counter += 1
-    return counter
+    return _create_all(manager=dest.notes, payloads=payloads, data=data)
 
 
 @_call_logger
@@ -347,7 +689,7 @@ def migrate_merge_requests(
 ) -> Tuple[int, int]:
     counter = 0
     n_counter = 0
-    for mr in source.mergerequests.list(as_list=False, sort="asc", state="opened"):
+    for mr in _list_all(source.mergerequests, sort="asc", state="opened"):
         description = "By {}: {}".format(mr.author["name"], mr.description)
         args = {
             "source_branch": mr.source_branch,
@@ -358,7 +700,7 @@ def migrate_merge_requests(
         }
         new_mr = dest.mergerequests.create(args)
         counter += 1
-        n_counter += migrate_notes(source=mr, dest=new_mr)
+        n_counter += migrate_notes(source=mr, dest=new_mr, data=data)
     return (counter, n_counter)
 
 
@@ -366,7 +708,7 @@ def migrate_merge_requests(
 def migrate_issues(source: Any, dest: Any, data: AlbatrossData) -> Tuple[int, int]:
     counter = 0
     n_counter = 0
-    for issue in source.issues.list(as_list=False, sort="asc"):
+    for issue in _list_all(source.issues, sort="asc"):
         description = "By {}: {}".format(issue.author["name"], issue.description)
         args = {
             "title": issue.title,
@@ -381,10 +723,11 @@ def migrate_issues(source: Any, dest: Any, data: AlbatrossData) -> Tuple[int, in
             args["due_date"] = issue.due_date
         d_issue = dest.issues.create(args)
         counter += 1
-        n_counter += migrate_notes(source=issue, dest=d_issue)
+        n_counter += migrate_notes(source=issue, dest=d_issue, data=data)
         if issue.state == "closed":
+            # The create endpoint takes no state, so closing needs its own update
             d_issue.state_event = "close"
-        d_issue.save()
+            d_issue.save()
     return (counter, n_counter)
 
 
@@ -410,54 +753,54 @@ def migrate_project_fill(source: Any, dest: Any, data: AlbatrossData) -> None:
     name = source.name
     archived: bool = source.archived
     if archived:
-        logging.info("Project {} is archived - migration will be reduced".format(name))
+        logging.info("Project %s is archived - migration will be reduced", name)
 
     if archived:
-        logging.debug(
-            "Project {} is archived - will not migrate variables".format(name)
-        )
+        logging.debug("Project %s is archived - will not migrate variables", name)
     else:
         if source.jobs_enabled:
-            num_vars = migrate_variables(source=source, dest=dest)
+            num_vars = migrate_variables(source=source, dest=dest, data=data)
             if num_vars > 0:
-                logging.info(
-                    "Migrated {} variables in project {}".format(num_vars, name)
-                )
+                logging.info("Migrated %s variables in project %s", num_vars, name)
         else:
-            logging.debug(
-                "CI disabled in project {}; won't migrate variables".format(name)
-            )
+            logging.debug("CI disabled in project %s; won't migrate variables", name)
 
-    num_labels = migrate_labels(source=source, dest=dest)
+    num_labels = migrate_labels(source=source, dest=dest, data=data)
     if num_labels > 0:
-        logging.info("Migrated {} labels in project {}".format(num_labels, name))
+        logging.info("Migrated %s labels in project %s", num_labels, name)
 
-    logging.debug("Starting repository migration")
-    git, lfs = migrate_repo(
-        source_url=source.http_url_to_repo,
-        dest_url=dest.http_url_to_repo,
-        data=data,
-    )
-    logging.info(
-        "Migrated {} (plus {} in LFS) repository data in project {}".format(
-            git, lfs, name
+    if dest.import_status != "none" and await_server_import(project=dest, data=data):
+        logging.info("Imported repository of project %s server-side", name)
+    else:
+        # Group listings can't include statistics, and only staging needs them
+        with_stats = data.source.projects.get(source.id, statistics=True)
+        statistics = with_stats.attributes.get("statistics")
+        # Without statistics (e.g. too little access), assume LFS might be in use
+        with_lfs = statistics is None or statistics["lfs_objects_size"] > 0
+        logging.debug("Waiting for a staging slot")
+        with data.staging_slots:
+            logging.debug("Starting repository migration")
+            git, lfs = migrate_repo(
+                source_url=source.http_url_to_repo,
+                dest_url=dest.http_url_to_repo,
+                with_lfs=with_lfs,
+                data=data,
+            )
+        logging.info(
+            "Migrated %s (plus %s in LFS) repository data in project %s", git, lfs, name
         )
-    )
-    _pause(data)
 
-    num_ptag = migrate_protected_tags(source=source, dest=dest)
+    num_ptag = migrate_protected_tags(source=source, dest=dest, data=data)
     if num_ptag > 0:
-        logging.info("Migrated {} protected tags in project {}".format(num_ptag, name))
+        logging.info("Migrated %s protected tags in project %s", num_ptag, name)
 
-    num_pbranch = migrate_protected_branches(source=source, dest=dest)
+    num_pbranch = migrate_protected_branches(source=source, dest=dest, data=data)
     if num_pbranch > 0:
-        logging.info(
-            "Migrated {} protected branches in project {}".format(num_pbranch, name)
-        )
+        logging.info("Migrated %s protected branches in project %s", num_pbranch, name)
 
     (num_stones, data) = migrate_milestones(source=source, dest=dest, data=data)
     if num_stones > 0:
-        logging.info("Migrated {} milestones in project {}".format(num_stones, name))
+        logging.info("Migrated %s milestones in project %s", num_stones, name)
 
     if source.merge_requests_enabled:
         (num_mrs, num_notes) = migrate_merge_requests(
@@ -465,144 +808,205 @@ def migrate_project_fill(source: Any, dest: Any, data: AlbatrossData) -> None:
         )
         if num_mrs > 0:
             logging.info(
-                "Migrated {} open merge requests, containing {} notes, in project {}".format(
-                    num_mrs, num_notes, name
-                )
+                "Migrated %s open merge requests, containing %s notes, in project %s",
+                num_mrs,
+                num_notes,
+                name,
             )
     else:
-        logging.debug("Merge requests disabled in project {}".format(name))
+        logging.debug("Merge requests disabled in project %s", name)
 
     if source.issues_enabled:
         (num_issues, num_notes) = migrate_issues(source=source, dest=dest, data=data)
         if num_issues > 0:
             logging.info(
-                "Migrated {} issues, containing {} notes, in project {}".format(
-                    num_issues, num_notes, name
-                )
+                "Migrated %s issues, containing %s notes, in project %s",
+                num_issues,
+                num_notes,
+                name,
             )
     else:
-        logging.debug("Issues disabled in project {}".format(name))
+        logging.debug("Issues disabled in project %s", name)
 
     if source.wiki_enabled:
         num_wiki = migrate_wikis(source=source, dest=dest)
         if num_wiki > 0:
-            logging.info("Migrated {} wiki pages in project {}".format(num_wiki, name))
+            logging.info("Migrated %s wiki pages in project %s", num_wiki, name)
     else:
-        logging.debug("Wikis disabled in project {}".format(name))
+        logging.debug("Wikis disabled in project %s", name)
 
-    num_pipes = halt_ci(project=dest)
+    num_pipes = halt_ci(project=dest, data=data)
     if num_pipes > 0:
-        logging.info(
-            "Removed {} pending CI pipelines in project {}".format(num_pipes, name)
-        )
+        logging.info("Removed %s pending CI pipelines in project %s", num_pipes, name)
 
     if archived:
         dest.archive()
-        logging.info("Archived destination project {}".format(name))
+        logging.info("Archived destination project %s", name)
 
 
 @_call_logger
 def migrate_project_fill_with_state(
     source: Any, dest: Any, data: AlbatrossData
 ) -> None:
-    data.state_map["project"][source.id] = {"id": dest.id, "done": False}
-    _json_dump_helper(data.state_map, data.state_file)
+    with data.state_lock:
+        data.state_map["project"][source.id] = {"id": dest.id, "done": False}
+        _journal(
+            {"op": "project_start", "src": source.id, "dst": dest.id}, data.state_file
+        )
 
     migrate_project_fill(source=source, dest=dest, data=data)
 
-    data.state_map["project"][source.id]["done"] = True
-    _json_dump_helper(data.state_map, data.state_file)
+    with data.state_lock:
+        data.state_map["project"][source.id]["done"] = True
+        # Losing this to a power cut only means the project gets migrated again, so
+        # the OS may write it back whenever it likes
+        _journal({"op": "project_done", "src": source.id}, data.state_file, sync=False)
 
 
 @_call_logger
-def migrate_project_create(source: Any, dest_gid: int, data: AlbatrossData) -> None:
+def migrate_project_create(
+    source: Any, dest_gid: int, d_ns: Optional[str], data: AlbatrossData
+) -> None:
     name = source.name
     s_ns = source.namespace.get("full_path")
-    d_ns = data.dest.groups.get(dest_gid).full_path
-    logging.info(
-        "Migrating project {} from source namespace {} to destination namespace {}".format(
-            name, s_ns, d_ns
-        )
-    )
-
     if data.dry_run:
         logging.warning(
-            "DRY RUN: project {} from namespace {} will not be migrated".format(
-                name, s_ns
-            )
+            "DRY RUN: project %s from namespace %s will not be migrated", name, s_ns
         )
         return
 
-    logging.debug("Creating project {} in namespace ID {}".format(name, dest_gid))
-    d_project = data.dest.projects.create({"name": name, "namespace_id": dest_gid})
-    d_project.description = source.description
+    logging.info(
+        "Migrating project %s from source namespace %s to destination namespace %s",
+        name,
+        s_ns,
+        d_ns,
+    )
 
+    logging.debug("Creating project %s in namespace ID %s", name, dest_gid)
+    args = {"name": name, "namespace_id": dest_gid, "description": source.description}
+    avatar = None
     if source.avatar_url is not None:
         if data.cookie is not None:
-            migrate_avatar(url=source.avatar_url, dest=d_project, cookie=data.cookie)
+            avatar = fetch_avatar(url=source.avatar_url, cookie=data.cookie)
         else:
             logging.warning(
-                "Avatar of project {} in namespace {} will not be migrated due to missing session cookie".format(
-                    name, s_ns
-                )
+                "Avatar of project %s in namespace %s will not be migrated due to missing session cookie",
+                name,
+                s_ns,
             )
-
-    d_project.save()
+    d_project = None
+    if data.server_import:
+        import_url = _authenticated_url(url=source.http_url_to_repo, gl=data.source)
+        try:
+            d_project = data.dest.projects.create({**args, "import_url": import_url})
+        except gitlab.exceptions.GitlabCreateError as e:
+            # Only a refused import_url (blocked, unreachable, imports disabled) is worth
+            # retrying without it; anything else, e.g. a taken name, would fail again
+            if "import" not in str(e.error_message).lower():
+                raise
+            logging.warning(
+                "Destination refused to import project %s server-side (%s); it will be staged locally",
+                name,
+                e.error_message,
+            )
+    if d_project is None:
+        d_project = data.dest.projects.create(args)
+    if avatar is not None:
+        _save_avatar(d_project, avatar)
 
     migrate_project_fill_with_state(source=source, dest=d_project, data=data)
 
 
 @_call_logger
-def migrate_project(project: Any, dest_gid: int, data: AlbatrossData) -> None:
-    source_id = str(project.id)
+def migrate_project(
+    project: Any, dest_gid: int, d_ns: Optional[str], data: AlbatrossData
+) -> None:
+    source_id = project.id
+    proj_state = data.state_map["project"].get(source_id)
 
-    if source_id in data.state_map["project"]:
-        if data.state_map["project"][source_id]["done"]:
+    if proj_state is not None:
+        dest_id = proj_state["id"]
+        if proj_state["done"]:
             logging.info(
-                "Project {} ({} -> {}) already successfully migrated".format(
-                    project.name, source_id, data.state_map["project"][source_id]["id"]
-                )
+                "Project %s (%s -> %s) already successfully migrated",
+                project.name,
+                source_id,
+                dest_id,
             )
             return
         else:
             logging.warning(
-                "Project {} ({} -> {}) incompletely migrated. Deleting and retrying".format(
-                    project.name, source_id, data.state_map["project"][source_id]["id"]
-                )
-            )
-            logging.info(
-                "Deleting project ID {} at the destination".format(
-                    data.state_map["project"][source_id]["id"]
-                )
+                "Project %s (%s -> %s) incompletely migrated. Deleting and retrying",
+                project.name,
+                source_id,
+                dest_id,
             )
+            logging.info("Deleting project ID %s at the destination", dest_id)
             if not data.dry_run:
-                data.dest.projects.delete(data.state_map["project"][source_id]["id"])
-                del data.state_map["project"][source_id]
+                data.dest.projects.delete(dest_id)
+                with data.state_lock:
+                    del data.state_map["project"][source_id]
+                    _journal(
+                        {"op": "project_delete", "src": source_id}, data.state_file
+                    )
                 _pause(data)
             else:
-                logging.warning(
-                    "DRY RUN: project {} will not be deleted".format(project.name)
-                )
+                logging.warning("DRY RUN: project %s will not be deleted", project.name)
     logging.debug("Ensuring the one, true project")
-    project = data.source.projects.get(project.id)
+    # The group listing already carries every attribute, but as a GroupProject, which
+    # lacks the sub-resource managers; rewrap it rather than fetching it again
+    project = Project(data.source.projects, project.attributes)
 
-    if len(project.branches.list(all=True)) == 0:
+    if not project.branches.list(page=1, per_page=1):
         logging.warning(
-            "Project {} ({}) contains no branches and will not be migrated".format(
-                project.name, source_id
-            )
+            "Project %s (%s) contains no branches and will not be migrated",
+            project.name,
+            source_id,
         )
         return
 
-    migrate_project_create(source=project, dest_gid=dest_gid, data=data)
+    migrate_project_create(source=project, dest_gid=dest_gid, d_ns=d_ns, data=data)
+
+
+@_call_logger
+def migrate_project_claimed(
+    project: Any, dest_gid: int, d_ns: Optional[str], data: AlbatrossData
+) -> None:
+    # Sibling groups are walked concurrently, and a project shared into several of them
+    # is listed under each; only the walker that claims it may read and act on its
+    # state, or both would create it, or one delete it from under the other
+    if data.aborting.is_set():
+        logging.debug("Run is aborting; not migrating project %s", project.id)
+        return
+    with data.state_lock:
+        if project.id in data.projects_in_flight:
+            logging.info(
+                "Project %s (%s) is already being migrated", project.name, project.id
+            )
+            return
+        data.projects_in_flight.add(project.id)
+    try:
+        migrate_project(project=project, dest_gid=dest_gid, d_ns=d_ns, data=data)
+    finally:
+        with data.state_lock:
+            data.projects_in_flight.discard(project.id)
 
 
 @_call_logger
 def migrate_projects(
-    project_list: list[Any], dest_gid: int, data: AlbatrossData
+    project_list: Iterable[Any], dest_gid: int, data: AlbatrossData
 ) -> None:
-    for project in project_list:
-        migrate_project(project=project, dest_gid=dest_gid, data=data)
+    # Dry runs never use the destination namespace, so don't ask the destination for it
+    d_ns = None if data.dry_run else _get_dest_group(gid=dest_gid, data=data).full_path
+    # The pool is shared by all groups, so --workers bounds the whole run rather
+    # than each group walked concurrently
+    for _ in data.project_pool.map(
+        lambda project: migrate_project_claimed(
+            project=project, dest_gid=dest_gid, d_ns=d_ns, data=data
+        ),
+        project_list,
+    ):
+        pass
 
 
 @_call_logger
@@ -612,12 +1016,11 @@ def create_destination_group(source: Any, dest_parent: Any, data: AlbatrossData)
     while len(path) < 2:
         path = path + "x"
     logging.info(
-        "Creating group {} {}".format(
-            name,
-            "inside {}".format(dest_parent.name)
-            if dest_parent is not None
-            else "at instance root",
-        )
+        "Creating group %s %s",
+        name,
+        "inside {}".format(dest_parent.name)
+        if dest_parent is not None
+        else "at instance root",
     )
     args = {
         "name": name,
@@ -637,18 +1040,19 @@ def create_destination_group(source: Any, dest_parent: Any, data: AlbatrossData)
         args["emails_disabled"] = source.emails_disabled
     if source.mentions_disabled is not None:
         args["mentions_disabled"] = source.mentions_disabled
-    dest_group = data.dest.groups.create(args)
-    dest_group.description = source.description
+    avatar = None
     if source.avatar_url is not None:
         if data.cookie is not None:
-            migrate_avatar(url=source.avatar_url, dest=dest_group, cookie=data.cookie)
+            avatar = fetch_avatar(url=source.avatar_url, cookie=data.cookie)
         else:
             logging.warning(
-                "Avatar of group {} at {} will not be migrated due to missing session cookie".format(
-                    name, path
-                )
+                "Avatar of group %s at %s will not be migrated due to missing session cookie",
+                name,
+                path,
             )
-    dest_group.save()
+    dest_group = data.dest.groups.create(args)
+    if avatar is not None:
+        _save_avatar(dest_group, avatar)
     return dest_group
 
 
@@ -660,115 +1064,177 @@ def create_destination_group_with_state(
         source=source, dest_parent=dest_parent, data=data
     )
 
-    data.state_map["group"][source.id] = {"id": dest_group.id}
-    _json_dump_helper(data.state_map, data.state_file)
+    # Its subgroups and projects all look it up again by ID
+    data.dest_groups[dest_group.id] = dest_group
+    with data.state_lock:
+        data.state_map["group"][source.id] = {"id": dest_group.id}
+        _journal(
+            {"op": "group", "src": source.id, "dst": dest_group.id}, data.state_file
+        )
 
     return dest_group
 
 
 @_call_logger
 def migrate_group(source: Any, dest_parent: Any, data: AlbatrossData) -> None:
-    source_id = str(source.id)
+    source_id = source.id
     dest_group = None
     if source_id in data.state_map["group"]:
         logging.info(
-            "Group {} ({} -> {}) already successfully migrated".format(
-                source.name, source_id, data.state_map["group"][source_id]["id"]
-            )
+            "Group %s (%s -> %s) already successfully migrated",
+            source.name,
+            source_id,
+            data.state_map["group"][source_id]["id"],
+        )
+        dest_group = _get_dest_group(
+            gid=data.state_map["group"][source_id]["id"], data=data
         )
-        dest_group = data.dest.groups.get(data.state_map["group"][source_id]["id"])
     elif data.dry_run:
         dest_group = dest_parent
         logging.warning(
-            "DRY RUN: group {} ({}) will not be migrated".format(source.name, source.id)
+            "DRY RUN: group %s (%s) will not be migrated", source.name, source.id
         )
         logging.warning("DRY RUN: subsequent target namespaces may be incorrect")
     else:
         dest_group = create_destination_group_with_state(
             source=source, dest_parent=dest_parent, data=data
         )
-        num_vars = migrate_variables(source=source, dest=dest_group)
+        num_vars = migrate_variables(source=source, dest=dest_group, data=data)
         if num_vars > 0:
-            logging.info(
-                "Migrated {} variables in group {}".format(num_vars, dest_group.name)
-            )
-    logging.debug("Iterating over projects of source group {}".format(source.id))
+            logging.info("Migrated %s variables in group %s", num_vars, dest_group.name)
+    logging.debug("Iterating over projects of source group %s", source.id)
     migrate_projects(
-        project_list=source.projects.list(all=True), dest_gid=dest_group.id, data=data
+        project_list=source.projects.list(as_list=False),
+        dest_gid=dest_group.id,
+        data=data,
     )
-    logging.debug("Iterating over subgroups of source group {}".format(source.id))
+    logging.debug("Iterating over subgroups of source group %s", source.id)
     migrate_subgroups(
-        subgroup_list=source.subgroups.list(all=True), dest_gid=dest_group.id, data=data
+        subgroup_list=source.subgroups.list(as_list=False),
+        dest_gid=dest_group.id,
+        data=data,
     )
     logging.info(
-        "Finished migrating group tree of {} (ID {} -> {})".format(
-            source.name, source.id, dest_group.id
-        )
+        "Finished migrating group tree of %s (ID %s -> %s)",
+        source.name,
+        source.id,
+        dest_group.id,
+    )
+
+
+def _probe_group(group: Any, data: AlbatrossData) -> Tuple[bool, list[Any]]:
+    """Returns whether the group itself holds projects, and if not, its subgroups"""
+    if group.projects.list(page=1, per_page=1, simple=True):
+        return (True, [])
+    # Lazy, since only the managers of the subgroups are needed
+    return (
+        False,
+        [
+            data.source.groups.get(subgroup.id, lazy=True)
+            for subgroup in group.subgroups.list(as_list=False)
+        ],
     )
 
 
 @_call_logger
 def probe_subtree(group: Any, data: AlbatrossData) -> bool:
-    """Returns true if the group contains a project or a group which does. Runs recursively."""
-    if len(group.projects.list(all=False)) > 0:
-        return True
-    else:
-        for subgroup in group.subgroups.list(as_list=False):
-            if probe_subtree(group=data.source.groups.get(subgroup.id), data=data):
-                return True
+    """Returns true if the group contains a project or a group which does. Probes the
+    subtree a level at a time, concurrently, and stops at the first project found."""
+    level = [group]
+    with ThreadPoolExecutor(max_workers=_PAGE_WORKERS) as executor:
+        while level:
+            futures = [executor.submit(_probe_group, group, data) for group in level]
+            level = []
+            for future in as_completed(futures):
+                has_projects, subgroups = future.result()
+                if has_projects:
+                    for pending in futures:
+                        pending.cancel()
+                    return True
+                level.extend(subgroups)
     return False
 
 
 @_call_logger
 def migrate_subgroup(subgroup: Any, dest_gid: int, data: AlbatrossData) -> None:
+    if data.aborting.is_set():
+        logging.debug("Run is aborting; not migrating group %s", subgroup.id)
+        return
     logging.debug("Getting true group")
     group = data.source.groups.get(subgroup.id)
 
-    logging.debug("Ensuring group {} isn't empty".format(group.id))
+    logging.debug("Ensuring group %s isn't empty", group.id)
     if not probe_subtree(group=group, data=data):
         logging.warning(
-            "Group {} (id {}, at {}) is empty and will not be migrated".format(
-                group.name, group.id, group.full_path
-            )
+            "Group %s (id %s, at %s) is empty and will not be migrated",
+            group.name,
+            group.id,
+            group.full_path,
         )
         return
 
     migrate_group(
         source=group,
-        dest_parent=data.dest.groups.get(dest_gid) if dest_gid > 0 else None,
+        dest_parent=_get_dest_group(gid=dest_gid, data=data) if dest_gid > 0 else None,
         data=data,
     )
 
 
 @_call_logger
 def migrate_subgroups(
-    subgroup_list: list[Any], dest_gid: int, data: AlbatrossData
+    subgroup_list: Iterable[Any], dest_gid: int, data: AlbatrossData
 ) -> None:
-    for subgroup in subgroup_list:
-        migrate_subgroup(subgroup=subgroup, dest_gid=dest_gid, data=data)
+    with ThreadPoolExecutor(max_workers=_GROUP_WORKERS) as executor:
+        try:
+            for _ in executor.map(
+                lambda subgroup: migrate_subgroup(
+                    subgroup=subgroup, dest_gid=dest_gid, data=data
+                ),
+                subgroup_list,
+            ):
+                pass
+        except BaseException:
+            # Otherwise leaving the with-block waits for every sibling walker to finish
+            # its whole subtree before the error gets anywhere
+            data.aborting.set()
+            executor.shutdown(cancel_futures=True)
+            raise
 
 
 @_wrap_statefile
 @_call_logger
 def migrate(data: AlbatrossData) -> None:
-    logging.debug("Retrieving source group")
-    sg = data.source.groups.get(data.source_gid)
-
-    logging.debug("Enumerating orphans")
-    orphans = sg.projects.list(all=True)
-    if len(orphans) == 0:
+    if data.reference_cache is not None:
+        logging.debug("Preparing reference cache at %s", data.reference_cache)
+        _git("init", "--quiet", "--bare", data.reference_cache)
+
+    # Lazy, since only its projects and subgroups managers are used
+    sg = data.source.groups.get(data.source_gid, lazy=True)
+
+    logging.debug("Enumerating orphans and subgroups")
+    # The two listings are independent, so their first pages load side by side
+    subgroups_listing = data.pool.submit(sg.subgroups.list, as_list=False)
+    # Streamed, so the first projects are migrating while later pages are fetched
+    orphans = sg.projects.list(as_list=False)
+    if orphans.total == 0:
         logging.info("No orphans to migrate")
     else:
-        logging.info("Migrating {} orphans...".format(len(orphans)))
+        # GitLab leaves out the total for very large listings
+        if orphans.total is None:
+            logging.info("Migrating orphans...")
+        else:
+            logging.info("Migrating %s orphans...", orphans.total)
         migrate_projects(project_list=orphans, dest_gid=data.orphan_gid, data=data)
     logging.info("Finished migrating orphans")
 
-    logging.debug("Enumerating subgroups")
-    subgroups = sg.subgroups.list(all=True)
-    if len(subgroups) == 0:
+    subgroups = subgroups_listing.result()
+    if subgroups.total == 0:
         logging.info("No subgroups to migrate")
     else:
-        logging.info("Migrating {} subgroups...".format(len(subgroups)))
+        if subgroups.total is None:
+            logging.info("Migrating subgroups...")
+        else:
+            logging.info("Migrating %s subgroups...", subgroups.total)
         migrate_subgroups(subgroup_list=subgroups, dest_gid=data.main_gid, data=data)
     logging.info("Finished migrating subgroups")
 
@@ -803,9 +1269,10 @@ called "orphan projects" - can't be created at the instance root, so will requir
 actual GID on the destination side. Groups which contain no subgroups or projects will
 not be migrated.
 
-This tool uses the local system as a staging environment when pulling data from the
-source and pushing to the target. Make sure you have enough disk space available to
-accomodate that.
+Repositories are imported by the destination straight from the source where possible.
+Otherwise, this tool uses the local system as a staging environment when pulling data
+from the source and pushing to the target. Make sure you have enough disk space
+available to accomodate that.
 
 Any commandline option can also be given via environment variables. i.e. the
 "source-url" value can be given via the variable "ALBATROSS_SOURCE_URL".
@@ -872,7 +1339,32 @@ Any commandline option can also be given via environment variables. i.e. the
     type=int,
     default=2,
     show_default=True,
-    help="Number of seconds to pause after a repository migration to let the destination catch its breath. If you find that branch protection calls fail for no reason, try increasing this.",
+    help="Number of seconds to pause after deleting an incompletely migrated project, to let the destination catch its breath. Also the interval for checking on server-side imports.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of projects to migrate concurrently.",
+)
+@click.option(
+    "--staging-workers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Number of repositories that may be staged locally at the same time. Each one takes up disk space and bandwidth for its full clone.",
+)
+@click.option(
+    "--server-import/--no-server-import",
+    default=True,
+    show_default=True,
+    help="Have the destination import repositories directly from the source, staging them locally only if that fails.",
+)
+@click.option(
+    "--reference-cache",
+    type=click.Path(file_okay=False, resolve_path=True),
+    help="Bare repository which collects the objects of every locally staged repository, so objects shared between projects are only downloaded once. Created if missing and kept between runs.",
 )
 @_prepare_logger
 @_call_logger
@@ -889,6 +1381,10 @@ def main(
     verbose,
     debug,
     sleep_time,
+    workers,
+    staging_workers,
+    server_import,
+    reference_cache,
 ) -> None:
 
     logging.info("Opening connection to source")
@@ -897,21 +1393,35 @@ def main(
     logging.info("Opening connection to destination")
     dest = open_gitlab_connection(url=dest_url, token=dest_token)
 
-    data = AlbatrossData(
-        source=source,
-        dest=dest,
-        source_gid=source_group,
-        main_gid=dest_group,
-        orphan_gid=dest_orphan_group,
-        cookie=session_cookie,
-        dry_run=dry_run,
-        state_map={},
-        state_file=None,
-        sleep_time=sleep_time,
-    )
+    with ThreadPoolExecutor(max_workers=_API_WORKERS) as pool:
+        with ThreadPoolExecutor(max_workers=workers) as project_pool:
+            data = AlbatrossData(
+                source=source,
+                dest=dest,
+                source_gid=source_group,
+                main_gid=dest_group,
+                orphan_gid=dest_orphan_group,
+                cookie=session_cookie,
+                dry_run=dry_run,
+                state_map={},
+                state_file=None,
+                sleep_time=sleep_time,
+                project_pool=project_pool,
+                state_lock=threading.Lock(),
+                pool=pool,
+                source_git_env=_git_env(source),
+                dest_git_env=_git_env(dest),
+                server_import=server_import,
+                reference_cache=reference_cache,
+                reference_lock=threading.Lock(),
+                staging_slots=threading.BoundedSemaphore(staging_workers),
+                dest_groups={},
+                projects_in_flight=set(),
+                aborting=threading.Event(),
+            )
 
-    logging.info("Starting migration...")
-    migrate(data=data)
+            logging.info("Starting migration...")
+            migrate(data=data)
 
     logging.info("Migration complete")
 